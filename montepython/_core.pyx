@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# cython: boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled Metropolis loop using Cython.
+"""
+
+import numpy as np
+
+def metropolis_loop(double[::1] p, double lnprob, double[:, ::1] D,
+                    double[::1] lnU, double[:, ::1] chain,
+                    double[::1] lnprob_buf, lnprobfn, tuple args):
+    """
+    Advance the chain ``len(D)`` steps, proposing ``p + D[i]`` at step
+    ``i`` and storing every step in ``chain`` and ``lnprob_buf``, unless
+    they are empty. ``lnprobfn`` is called as ``lnprobfn(q, *args)``,
+    where ``q`` is a buffer that is reused between steps. ``p`` is used as
+    a buffer too and may be overwritten. A proposal is accepted if the
+    difference in log-probability exceeds ``lnU[i]``. Returns the final
+    position, log-probability and the number of accepted proposals.
+    """
+    cdef Py_ssize_t n = D.shape[0]
+    cdef Py_ssize_t dim = p.shape[0]
+    cdef Py_ssize_t i, j
+    cdef bint store = chain.shape[0] > 0
+    cdef long accepted = 0
+    cdef double newlnprob
+    cdef double[::1] current = p
+    cdef double[::1] q
+
+    current_arr = np.asarray(p)
+    q_arr = np.empty(dim)
+    q = q_arr
+    for i in range(n):
+        for j in range(dim):
+            q[j] = current[j] + D[i, j]
+        newlnprob = lnprobfn(q_arr, *args)
+        if lnU[i] < newlnprob - lnprob:
+            # Swap the buffers rather than copying the proposal
+            current, q = q, current
+            current_arr, q_arr = q_arr, current_arr
+            lnprob = newlnprob
+            accepted += 1
+
+        if store:
+            chain[i, :] = current
+            lnprob_buf[i] = lnprob
+    return current_arr, lnprob, accepted
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled kernels for the Metropolis sampler using ``numba``.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import numpy as np
+
+try:
+    import numba
+    from numba.core.errors import NumbaError
+except ImportError:
+    numba = None
+    NumbaError = None
+
+def jit_lnprobfn(lnprobfn):
+    """
+    Compile ``lnprobfn`` in ``nopython`` mode. Functions that are already
+    decorated with ``numba.njit`` are returned as they are.
+    """
+    if isinstance(lnprobfn, numba.core.dispatcher.Dispatcher):
+        return lnprobfn
+    return numba.njit(lnprobfn)
+
+def _metropolis_kernel(p, lnprob, D, lnU, chain, lnprob_buf, lnprobfn, args):
+    """
+    Advance the chain ``len(D)`` steps, proposing ``p + D[i]`` at step
+    ``i`` and storing every step in ``chain`` and ``lnprob_buf``, unless
+    they are empty. ``p`` is used as a buffer and may be overwritten. A
+    proposal is accepted if the difference in log-probability exceeds
+    ``lnU[i]``. Returns the final position, log-probability and the number
+    of accepted proposals.
+    """
+    dim = p.shape[0]
+    store = chain.shape[0] > 0
+    accepted = 0
+    q = np.empty(dim)
+    for i in range(D.shape[0]):
+        for j in range(dim):
+            q[j] = p[j] + D[i, j]
+        newlnprob = lnprobfn(q, *args)
+        if lnU[i] < newlnprob - lnprob:
+            # Swap the buffers rather than copying the proposal
+            p, q = q, p
+            lnprob = newlnprob
+            accepted += 1
+
+        if store:
+            chain[i, :] = p
+            lnprob_buf[i] = lnprob
+    return p, lnprob, accepted
+
+if numba is not None:
+    _metropolis_kernel = numba.njit(_metropolis_kernel)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+A Metropolis sampler that runs the chain as a single compiled JAX program.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import functools
+import warnings
+
+import numpy as np
+
+from .metropolis_sampler import MetropolisSampler
+
+try:
+    import jax
+    import jax.numpy as jnp
+except ImportError:
+    jax = None
+
+def _metropolis_scan(lnprobfn, nstore, p0, lnprob0, L, key, N, thin, burnin,
+                     args, kwargs):
+    """
+    Run ``N`` Metropolis steps from ``p0``. Returns the final position and
+    log-probability, the number of accepted proposals in total and after
+    the first ``burnin`` steps and, unless ``nstore`` is ``None``, the
+    positions and log-probabilities of the first ``nstore`` of every
+    ``thin``-th step. The steps between stored samples are run in an inner
+    loop, so only the stored samples are kept in device memory.
+    """
+    def step(i, carry):
+        p, lnprob, accepted, accepted_post_burnin = carry
+        key_q, key_u = jax.random.split(jax.random.fold_in(key, i))
+        q = p + jnp.dot(L, jax.random.normal(key_q, p.shape, p.dtype))
+        newlnprob = lnprobfn(q, *args, **kwargs)
+
+        accept = jnp.log(jax.random.uniform(key_u)) < newlnprob - lnprob
+        p = jnp.where(accept, q, p)
+        lnprob = jnp.where(accept, newlnprob, lnprob)
+        return (p, lnprob, accepted + accept,
+                accepted_post_burnin + (accept & (i >= burnin)))
+
+    carry = (p0, lnprob0, jnp.array(0), jnp.array(0))
+    if nstore is not None:
+        def block(carry, start):
+            # Store the first step of every block of ``thin`` steps
+            carry = step(start, carry)
+            sample = carry[:2]
+            carry = jax.lax.fori_loop(start + 1,
+                                      jnp.minimum(start + thin, N), step,
+                                      carry)
+            return carry, sample
+
+        carry, (chain, lnprobs) = jax.lax.scan(block, carry,
+                                               jnp.arange(nstore) * thin)
+    else:
+        carry = jax.lax.fori_loop(0, N, step, carry)
+        chain, lnprobs = None, None
+    p, lnprob, accepted, accepted_post_burnin = carry
+    return p, lnprob, accepted, accepted_post_burnin, chain, lnprobs
+
+if jax is not None:
+    # Compiled once per ``lnprobfn``, number of stored samples and shape of
+    # the inputs, and reused from JAX's cache afterwards. The number of
+    # steps is not static, so runs that store nothing compile only once
+    metropolis_scan = functools.partial(
+        jax.jit, static_argnames=("lnprobfn", "nstore"))(_metropolis_scan)
+else:
+    metropolis_scan = None
+
+class JaxMetropolisSampler(MetropolisSampler):
+    """
+    A Metropolis sampler whose ``run`` compiles the whole chain into one
+    XLA program with ``jax.jit`` and ``jax.lax.scan``, so it can run
+    without Python overhead and on a GPU or TPU.
+
+    Parameters
+    ----------
+
+    cov : list or float
+        The covariance matrix to use for the Gaussian proposal distribution.
+    dim : int
+        The number of dimensions in the parameter space.
+    lnprobfn : function
+        A function written with ``jax.numpy`` that takes a vector in the
+        parameter space as input and returns the natural logarithm of the
+        probability at that position.
+    args : list (optional)
+        Positional arguments for ``lnprobfn``. ``lnprobfn`` will be called
+        as ``lnprobfn(p, *args, **kwargs)``.
+    kwargs : dict (optional)
+        Keyword arguments for ``lnprobfn``. ``lnprobfn`` will be called as
+        ``lnprobfn(p, *args, **kwargs)``.
+
+    Notes
+    -----
+
+    If ``jax`` is not installed, the sampler warns and behaves like
+    ``MetropolisSampler``. ``sample`` always uses the NumPy loop, since the
+    compiled program only returns once the whole chain is done.
+
+    The JAX random key for each run is drawn from the internal random number
+    generator, so the results are reproducible through ``random_state``,
+    but they differ from those of ``MetropolisSampler``. JAX computes in
+    single precision unless ``jax_enable_x64`` is set.
+
+    The compiled program is reused for the same ``lnprobfn`` and
+    dimension, but the length of the stored chain is fixed at compile time.
+    Each ``run`` that stores a new number of samples therefore compiles
+    again, which can take seconds. Runs with ``store_chain=False`` compile
+    only once.
+    """
+    def __init__(self, cov, *args, **kwargs):
+        super(JaxMetropolisSampler, self).__init__(cov, *args, **kwargs)
+        if jax is None:
+            warnings.warn("jax is not installed, falling back to NumPy")
+        elif self.vectorize:
+            warnings.warn("vectorize=True is not supported with jax, "
+                          "falling back to NumPy")
+
+    def _sample_bulk(self, p, lnprob=None, rstate=None, thin=1,
+                     store_chain=True, iterations=1, return_state=False,
+                     burnin=None):
+        """
+        Run the chain to the end as a compiled ``lax.scan`` and return the
+        last result.
+        """
+        if jax is None or self.vectorize:
+            return super(JaxMetropolisSampler, self)._sample_bulk(
+                p, lnprob, rstate, thin, store_chain, iterations,
+                return_state, burnin)
+
+        p, lnprob, burnin = self._prepare(p, lnprob, rstate, thin,
+                                          store_chain, iterations, burnin)
+        shape = np.shape(p)
+        m = len(range(0, iterations, thin)) if store_chain else None
+
+        key = jax.random.PRNGKey(self._random.integers(2**32))
+        p0 = jnp.asarray(np.reshape(p, self.dim), dtype=float)
+        (p, lnprob, accepted, accepted_post_burnin, chain,
+         lnprobs) = metropolis_scan(
+            self.lnprobfn, m, p0, jnp.asarray(lnprob, dtype=p0.dtype),
+            jnp.asarray(self._L, dtype=p0.dtype), key, iterations, thin,
+            burnin, tuple(self.args), dict(self.kwargs))
+
+        self.iterations += iterations
+        self.accepted += int(accepted)
+        self.accepted_post_burnin += int(accepted_post_burnin)
+        if store_chain:
+            stored = self._samples[self._nstored:]
+            stored["p"][:m] = np.asarray(chain)
+            stored["ln"][:m] = np.asarray(lnprobs)
+            self._nstored += m
+
+        return (np.asarray(p).reshape(shape), float(lnprob),
+                self.random_state)
@@ -6,10 +6,22 @@ A Metropolis sampler.
 from __future__ import (absolute_import, division, print_function, 
                         unicode_literals)
 
+import warnings
+
 import numpy as np
 
+from . import _numba
 from .sampler import Sampler
 
+try:
+    from . import _core
+except ImportError:
+    _core = None
+
+# Random numbers are drawn in blocks of this many steps, which amortises the
+# cost of calling the generator while bounding the memory used
+_BLOCK_SIZE = 4096
+
 class MetropolisSampler(Sampler):
     """
     A basic implementation of the Metropolis algorithm.
@@ -30,6 +42,16 @@ class MetropolisSampler(Sampler):
     kwargs : dict (optional)
         Keyword arguments for ``lnprobfn``. ``lnprobfn`` will be called as 
         ``lnprobfn(p, *args, **kwargs)``.
+    jit : bool (optional)
+        If ``True``, compile ``lnprobfn`` and the accept/reject loop with
+        ``numba``. This requires ``numba`` to be installed and ``lnprobfn``
+        to be compatible with ``numba.njit``.
+    vectorize : bool (optional)
+        If ``True``, run an ensemble of independent chains in lockstep.
+        ``sample`` then takes an array of shape ``(nwalkers, dim)`` of
+        starting positions and ``lnprobfn`` is called once per step with
+        the proposals for all walkers, returning an array of shape
+        ``(nwalkers,)``.
     
     Notes
     -----
@@ -38,13 +60,68 @@ class MetropolisSampler(Sampler):
     multidimensional or one-dimensional. In the one-dimensional case, 
     ``cov`` is interpreted as the variance of the Gaussian proposal 
     distribution.
+
+    With ``jit=True`` the sampler falls back to the Python loop, with a
+    warning, if ``numba`` is not installed, ``kwargs`` are given or the
+    compilation fails. The proposals and uniform draws still come from the
+    internal random number generator, but ``numba`` keeps a separate state
+    for ``np.random`` inside compiled functions, so any random numbers drawn
+    by ``lnprobfn`` itself are not controlled by ``random_state``.
+
+    With ``vectorize=True`` the ``chain`` has shape
+    ``(nsamples, nwalkers, dim)``, ``lnprobability`` has shape
+    ``(nsamples, nwalkers)`` and ``acceptance_fraction`` is given for each
+    walker. ``jit`` is ignored in this case.
+
+    To avoid allocating a new array every step, ``run`` reuses the arrays
+    of positions passed to ``lnprobfn``, so ``lnprobfn`` should not keep a
+    reference to its input.
     """
     def __init__(self, cov, *args, **kwargs):
+        jit = kwargs.pop("jit", False)
+        self.vectorize = kwargs.pop("vectorize", False)
         super(MetropolisSampler, self).__init__(*args, **kwargs)
         self.cov = cov
+
+        self._jit_lnprobfn = None
+        if jit:
+            if self.vectorize:
+                warnings.warn("jit=True is ignored with vectorize=True")
+            elif _numba.numba is None:
+                warnings.warn("numba is not installed, jit=True is ignored")
+            elif self.kwargs:
+                warnings.warn("numba does not support keyword arguments for "
+                              "lnprobfn, jit=True is ignored")
+            else:
+                self._jit_lnprobfn = _numba.jit_lnprobfn(self.lnprobfn)
+
+    @property
+    def cov(self):
+        """The covariance of the Gaussian proposal distribution."""
+        return self._cov
+
+    @cov.setter
+    def cov(self, cov):
+        """
+        Sets the covariance and caches its square root, so the proposal
+        distribution does not have to be factorised at every step.
+        """
+        self._cov = cov
+        if self.dim == 1:
+            self._L = np.atleast_2d(np.sqrt(cov))
+        else:
+            cov = np.atleast_2d(cov)
+            try:
+                self._L = np.linalg.cholesky(cov)
+            except np.linalg.LinAlgError:
+                # Like ``multivariate_normal``, fall back to the SVD for
+                # covariances that are not positive-definite
+                u, s, v = np.linalg.svd(cov)
+                self._L = u * np.sqrt(s)
     
     def sample(self, p, lnprob=None, rstate=None, thin=1, 
-               store_chain=True, iterations=1):
+               store_chain=True, iterations=1, return_state=False,
+               burnin=None):
         """
         Advances the the chain ``iterations`` steps as an iterator.
 
@@ -52,11 +129,13 @@ class MetropolisSampler(Sampler):
         ----------
 
         p : list
-            The starting position vector.
+            The starting position vector. With ``vectorize=True``, the
+            starting positions of the walkers as an array of shape
+            ``(nwalkers, dim)``.
         lnprob : list (optional)
             The log-probability at the starting position. If not provided, the
             values are calculated.
-        rstate : list (optional)
+        rstate : dict (optional)
             The state of the random number generator.
         thin : int (optional)
             If you only want to store and yield every ``thin`` samples in the
@@ -66,6 +145,14 @@ class MetropolisSampler(Sampler):
             of the samples in the chain.      
         iterations : int (optional)
             The number of steps to run.
+        return_state : bool (optional)
+            If ``True``, yield the state of the random number generator at
+            every step. By default it is only yielded at the last step.
+        burnin : int (optional)
+            The number of steps since the last ``reset`` that are burn-in.
+            Accepted proposals after these are also counted in
+            ``accepted_post_burnin``. The value is kept in ``burnin`` and
+            used by later runs that do not give it, until ``reset``.
         
         Returns
         -------
@@ -74,8 +161,9 @@ class MetropolisSampler(Sampler):
             The accepted position vector.        
         lnprob : list
             The log-probability at the accepted position vector.        
-        rstate : list
-            The state of the random number generator.
+        rstate : dict
+            The state of the random number generator, or ``None`` before the
+            last step unless ``return_state`` is ``True``.
         
         Notes
         -----
@@ -83,42 +171,394 @@ class MetropolisSampler(Sampler):
         If ``rstate`` is not provided the setting of the ``random_state``
         will fail silently and use the initial ``random_state``.
         """
+        p, lnprob, burnin = self._prepare(p, lnprob, rstate, thin,
+                                          store_chain, iterations, burnin)
+
+        if self.vectorize:
+            steps = self._sample_vectorized(p, lnprob, thin, store_chain,
+                                            iterations, return_state, burnin)
+        elif self._jit_lnprobfn is not None:
+            steps = self._sample_jit(p, lnprob, thin, store_chain, iterations,
+                                     return_state, burnin)
+        else:
+            steps = self._sample_python(p, lnprob, thin, store_chain,
+                                        iterations, return_state, burnin)
+        for results in steps:
+            yield results
+
+    def _proposal_steps(self, n, shape):
+        """
+        Draw the offsets of ``n`` proposals from positions of the given
+        ``shape``. The whole block is transformed by the factorised
+        covariance in a single matrix product rather than one per step.
+        """
+        nchains = int(np.prod(shape)) // self.dim
+        Z = self._random.standard_normal((n * nchains, self.dim))
+        return np.dot(Z, self._L.T).reshape((n,) + shape)
+
+    def _prepare(self, p, lnprob, rstate, thin, store_chain, iterations,
+                 burnin):
+        """
+        Set the state of the random number generator, make room in the
+        chain and return the starting position and log-probability, and the
+        number of steps of this run that are still burn-in.
+        """
         # This will fail silently if ``rstate=None`` and the initial
         # ``random_state`` will be used
         self.random_state = rstate
 
+        if burnin is None:
+            burnin = self.burnin
+        else:
+            self.burnin = burnin
+
         p = np.asarray(p)
         if lnprob is None:
             lnprob = self.get_lnprob(p)
         
         if store_chain:
-            N = int(iterations / thin)
-            self._chain = np.concatenate((self._chain,
-                                          np.zeros((N, self.dim))), axis=0)
-            self._lnprob = np.append(self._lnprob, np.zeros(N))
-        
-        i0 = self.iterations
+            # Every ``thin``-th step is stored, starting with the first
+            N = (iterations + thin - 1) // thin
+            self._grow_chain(N, len(p) if self.vectorize else None)
+
+        if self._jit_lnprobfn is not None:
+            self._compile_jit(p, lnprob)
+
+        return p, lnprob, max(burnin - self.iterations, 0)
+
+    def _sample_bulk(self, p, lnprob=None, rstate=None, thin=1,
+                     store_chain=True, iterations=1, return_state=False,
+                     burnin=None):
+        """
+        Run ``sample`` to the end without yielding every step and return
+        the last result.
+        """
+        p, lnprob, burnin = self._prepare(p, lnprob, rstate, thin,
+                                          store_chain, iterations, burnin)
+
+        if self.vectorize:
+            for results in self._sample_vectorized(p, lnprob, thin,
+                                                   store_chain, iterations,
+                                                   False, burnin):
+                pass
+            return results
+        if self._jit_lnprobfn is not None:
+            blocks = self._kernel_blocks(_numba._metropolis_kernel,
+                                         self._jit_lnprobfn, tuple(self.args),
+                                         p, lnprob, thin, store_chain,
+                                         iterations, burnin, False)
+        elif _core is not None and np.ndim(p) == 1:
+            # The compiled extension passes ``lnprobfn`` a vector, so scalar
+            # positions stay in the Python loops. It only passes positional
+            # arguments, so keyword arguments go through ``get_lnprob``
+            lnprobfn, args, kwargs = self._lnprob_function()
+            if kwargs:
+                lnprobfn, args = self.get_lnprob, ()
+            blocks = self._kernel_blocks(_core.metropolis_loop, lnprobfn,
+                                         args, p, lnprob, thin, store_chain,
+                                         iterations, burnin, False)
+        elif store_chain:
+            return self._run_python(p, lnprob, thin, iterations, burnin)
+        else:
+            return self._run_python_nostore(p, lnprob, iterations, burnin)
+
+        shape = np.shape(p)
+        for p, lnprob, _, _ in blocks:
+            pass
+        return p.reshape(shape), lnprob, self.random_state
+
+    def _sample_python(self, p, lnprob, thin, store_chain, iterations,
+                       return_state, burnin):
+        """The accept/reject loop of ``sample`` in pure Python."""
+        # Bind everything used in the loop to locals and only write the
+        # book-keeping parameters back before each ``yield``
+        lnprobfn, args, kwargs = self._lnprob_function()
+        random = self._random
+        shape = np.shape(p)
+        samples = self._samples
+        iterations0 = self.iterations
+        accepted = self.accepted
+        accepted_post_burnin = self.accepted_post_burnin
+        nstored = self._nstored
+
+        # The next step to store, starting with the first
+        next_store = 0 if store_chain else -1
+        last = iterations - 1
+        j = n = 0
         for i in range(iterations):
-            self.iterations += 1
+            if j == n:
+                n = min(_BLOCK_SIZE, iterations - i)
+                D = self._proposal_steps(n, shape)
+                lnU = np.log(random.random(n))
+                j = 0
 
-            if self.dim == 1:
-                q = self._random.normal(p, np.sqrt(self.cov))
+            q = p + D[j]
+            newlnprob = lnprobfn(q, *args, **kwargs)
+            # Accepting if ``log(u) < diff`` is equivalent to
+            # ``u < min(1, exp(diff))``, without evaluating the exponential
+            accept = lnU[j] < newlnprob - lnprob
+            j += 1
+            
+            if accept:
+                p = q
+                lnprob = newlnprob
+                accepted += 1
+                if i >= burnin:
+                    accepted_post_burnin += 1
+            
+            if i == next_store:
+                samples[nstored] = (p, lnprob)
+                nstored += 1
+                next_store += thin
+            
+            self.iterations = iterations0 + i + 1
+            self.accepted = accepted
+            self.accepted_post_burnin = accepted_post_burnin
+            self._nstored = nstored
+            if return_state or i == last:
+                yield p, lnprob, self.random_state
             else:
-                q = self._random.multivariate_normal(p, self.cov)
-            newlnprob = self.get_lnprob(q)
-            diff = newlnprob - lnprob
+                yield p, lnprob, None
+
+    def _run_python(self, p, lnprob, thin, iterations, burnin):
+        """
+        The accept/reject loop of ``_sample_python`` without yielding, for
+        ``run``. The book-keeping parameters are only written back at the
+        end.
+
+        Since no position is handed back before the end, the current
+        position and the proposal live in two buffers that are swapped on
+        acceptance instead of allocating a new array every step.
 
-            if diff < 0:
-                diff = np.exp(diff) - self._random.rand()
+        This loop always stores the chain; ``_run_python_nostore`` is the
+        same loop without any storage.
+        """
+        lnprobfn, args, kwargs = self._lnprob_function()
+        random = self._random
+        shape = np.shape(p)
+        samples = self._samples
+        iterations0 = self.iterations
+        accepted = self.accepted
+        accepted_post_burnin = self.accepted_post_burnin
+        nstored = self._nstored
+
+        p = np.array(p, dtype=float)
+        q = np.empty_like(p)
+
+        # The next step to store, starting with the first
+        next_store = 0
+        j = n = 0
+        for i in range(iterations):
+            if j == n:
+                n = min(_BLOCK_SIZE, iterations - i)
+                D = self._proposal_steps(n, shape)
+                lnU = np.log(random.random(n))
+                j = 0
+
+            np.add(p, D[j], out=q)
+            newlnprob = lnprobfn(q, *args, **kwargs)
+            # Accepting if ``log(u) < diff`` is equivalent to
+            # ``u < min(1, exp(diff))``, without evaluating the exponential
+            accept = lnU[j] < newlnprob - lnprob
+            j += 1
             
-            if diff > 0:
-                p = q
+            if accept:
+                p, q = q, p
                 lnprob = newlnprob
-                self.accepted += 1
+                accepted += 1
+                if i >= burnin:
+                    accepted_post_burnin += 1
             
-            if store_chain and i % thin == 0:
-                ind = i0 + int(i / thin)
-                self._chain[ind, :] = p
-                self._lnprob[ind] = lnprob
+            if i == next_store:
+                samples[nstored] = (p, lnprob)
+                nstored += 1
+                next_store += thin
+
+        self.iterations = iterations0 + iterations
+        self.accepted = accepted
+        self.accepted_post_burnin = accepted_post_burnin
+        self._nstored = nstored
+        return p, lnprob, self.random_state
+
+    def _run_python_nostore(self, p, lnprob, iterations, burnin):
+        """
+        ``_run_python`` specialised for ``store_chain=False``, so the loop
+        has no storage check at all.
+        """
+        lnprobfn, args, kwargs = self._lnprob_function()
+        random = self._random
+        shape = np.shape(p)
+        iterations0 = self.iterations
+        accepted = self.accepted
+        accepted_post_burnin = self.accepted_post_burnin
+
+        p = np.array(p, dtype=float)
+        q = np.empty_like(p)
+
+        j = n = 0
+        for i in range(iterations):
+            if j == n:
+                n = min(_BLOCK_SIZE, iterations - i)
+                D = self._proposal_steps(n, shape)
+                lnU = np.log(random.random(n))
+                j = 0
+
+            np.add(p, D[j], out=q)
+            newlnprob = lnprobfn(q, *args, **kwargs)
+            # Accepting if ``log(u) < diff`` is equivalent to
+            # ``u < min(1, exp(diff))``, without evaluating the exponential
+            accept = lnU[j] < newlnprob - lnprob
+            j += 1
             
-            yield p, lnprob, self.random_state
+            if accept:
+                p, q = q, p
+                lnprob = newlnprob
+                accepted += 1
+                if i >= burnin:
+                    accepted_post_burnin += 1
+
+        self.iterations = iterations0 + iterations
+        self.accepted = accepted
+        self.accepted_post_burnin = accepted_post_burnin
+        return p, lnprob, self.random_state
+
+    def _sample_vectorized(self, p, lnprob, thin, store_chain, iterations,
+                           return_state, burnin):
+        """
+        The accept/reject loop of ``sample`` for an ensemble of walkers,
+        with one call to ``lnprobfn`` per step for all of them.
+        """
+        lnprobfn = self.lnprobfn
+        args = self.args
+        kwargs = self.kwargs
+        random = self._random
+        shape = (len(p), self.dim)
+        samples = self._samples
+        iterations0 = self.iterations
+        accepted = self.accepted
+        accepted_post_burnin = self.accepted_post_burnin
+        nstored = self._nstored
+
+        next_store = 0 if store_chain else -1
+        last = iterations - 1
+        j = n = 0
+        for i in range(iterations):
+            if j == n:
+                n = min(_BLOCK_SIZE, iterations - i)
+                D = self._proposal_steps(n, shape)
+                lnU = np.log(random.random((n, shape[0])))
+                j = 0
+
+            # The cache in ``get_lnprob`` is bypassed since whole ensembles
+            # of positions are rarely repeated
+            q = p + D[j]
+            newlnprob = lnprobfn(q, *args, **kwargs)
+            accept = lnU[j] < newlnprob - lnprob
+            j += 1
+            p = np.where(accept[:, np.newaxis], q, p)
+            lnprob = np.where(accept, newlnprob, lnprob)
+            accepted = accepted + accept
+            if i >= burnin:
+                accepted_post_burnin = accepted_post_burnin + accept
+
+            if i == next_store:
+                samples[nstored] = (p, lnprob)
+                nstored += 1
+                next_store += thin
+
+            self.iterations = iterations0 + i + 1
+            self.accepted = accepted
+            self.accepted_post_burnin = accepted_post_burnin
+            self._nstored = nstored
+            if return_state or i == last:
+                yield p, lnprob, self.random_state
+            else:
+                yield p, lnprob, None
+
+    def _compile_jit(self, p, lnprob):
+        """
+        Compile the ``numba`` kernel for the types of ``p`` and ``lnprob``
+        by running it for zero steps. If this fails, warn and fall back to
+        the Python loop.
+        """
+        p = np.array(p, dtype=float).reshape(self.dim)
+        try:
+            _numba._metropolis_kernel(
+                p, lnprob, np.empty((0, self.dim)), np.empty(0),
+                np.empty((0, self.dim)), np.empty(0), self._jit_lnprobfn,
+                tuple(self.args))
+        except _numba.NumbaError as e:
+            warnings.warn("Compiling the Metropolis loop with numba "
+                          "failed, falling back to Python: {0}".format(e))
+            self._jit_lnprobfn = None
+
+    def _sample_jit(self, p, lnprob, thin, store_chain, iterations,
+                    return_state, burnin):
+        """
+        The accept/reject loop of ``sample`` compiled with ``numba``. Each
+        block of steps is run by the compiled kernel before its samples are
+        yielded.
+        """
+        shape = np.shape(p)
+        i = 0
+        last = iterations - 1
+        blocks = self._kernel_blocks(_numba._metropolis_kernel,
+                                     self._jit_lnprobfn, tuple(self.args), p,
+                                     lnprob, thin, store_chain, iterations,
+                                     burnin)
+        for _, _, positions, lnprobs in blocks:
+            for k in range(len(positions)):
+                if return_state or i == last:
+                    state = self.random_state
+                else:
+                    state = None
+                yield positions[k].reshape(shape), lnprobs[k], state
+                i += 1
+
+    def _kernel_blocks(self, kernel, lnprobfn, args, p, lnprob, thin,
+                       store_chain, iterations, burnin, record=True):
+        """
+        Run a compiled ``kernel`` one block of random numbers at a time,
+        updating the chain and book-keeping parameters. Yields the position
+        and log-probability at the end of each block and, if ``record`` or
+        ``store_chain``, the positions and log-probabilities of every step
+        in it. Otherwise these are empty and the kernel skips writing them.
+        """
+        p = np.array(p, dtype=float).reshape(self.dim)
+        record = record or store_chain
+        positions = np.empty((0, self.dim))
+        lnprobs = np.empty(0)
+
+        for i in range(0, iterations, _BLOCK_SIZE):
+            n = min(_BLOCK_SIZE, iterations - i)
+            D = self._proposal_steps(n, (self.dim,))
+            lnU = np.log(self._random.random(n))
+            if record:
+                positions = np.empty((n, self.dim))
+                lnprobs = np.empty(n)
+
+            # Run the burn-in and post-burn-in parts of the block separately
+            # to count the accepted proposals after the burn-in
+            k = min(max(burnin - i, 0), n)
+            p, lnprob, accepted = kernel(p, lnprob, D[:k], lnU[:k],
+                                         positions[:k], lnprobs[:k],
+                                         lnprobfn, args)
+            p, lnprob, accepted_post_burnin = kernel(
+                p, lnprob, D[k:], lnU[k:], positions[k:], lnprobs[k:],
+                lnprobfn, args)
+
+            self.iterations += n
+            self.accepted += accepted + accepted_post_burnin
+            self.accepted_post_burnin += accepted_post_burnin
+
+            if store_chain:
+                # Align the stored steps with every ``thin``-th step of the
+                # whole run
+                first = (-i) % thin
+                m = len(range(first, n, thin))
+                stored = self._samples[self._nstored:self._nstored + m]
+                stored["p"] = positions[first::thin]
+                stored["ln"] = lnprobs[first::thin]
+                self._nstored += m
+
+            yield p, lnprob, positions, lnprobs
@@ -6,6 +6,9 @@ A base sampler class.
 from __future__ import (absolute_import, division, print_function, 
                         unicode_literals)
 
+import copy
+from collections import OrderedDict
+
 import numpy as np
 
 class Sampler(object):
@@ -27,7 +30,21 @@ class Sampler(object):
     kwargs : dict (optional)
         Keyword arguments for ``lnprobfn``. ``lnprobfn`` will be called as 
         ``lnprobfn(p, *args, **kwargs)``.
+
+    Notes
+    -----
+
+    If ``lnprob_cache_size`` is set to a positive number, the most recent
+    evaluations of ``lnprobfn`` are cached by position, so repeated
+    positions (such as restarting ``run`` from the same point) are not
+    evaluated again. The cache is off by default, since proposals are
+    rarely repeated and looking them up slows down every step. It is
+    cleared by ``reset``. Setting ``lnprobfn``, ``args`` or ``kwargs``
+    also clears the cache, but changing ``args`` or ``kwargs`` in place does
+    not.
     """
+    lnprob_cache_size = 0
+
     def __init__(self, dim, lnprobfn, args=[], kwargs={}):
         self.dim = dim
         self.lnprobfn = lnprobfn
@@ -35,7 +52,7 @@ class Sampler(object):
         self.kwargs = kwargs
 
         # Starting the random number generator
-        self._random = np.random.mtrand.RandomState()
+        self._random = np.random.default_rng()
 
         self.reset()
     
@@ -44,17 +61,59 @@ class Sampler(object):
         Clear the ``chain``, ``lnprobability`` and reset the book-keeping
         parameters.
         """
-        self._chain = np.empty((0, self.dim))
-        self._lnprob = np.empty(0)
+        self._samples = np.empty(0, dtype=self._sample_dtype(None))
+        self._chain_capacity = 0
+        self._nstored = 0
         
         self.iterations = 0
         self.accepted = 0
+        self.accepted_post_burnin = 0
+        self.burnin = 0
         self._last_run = None
+        self._lnprob_cache = OrderedDict()
     
+    def _sample_dtype(self, nwalkers):
+        """
+        The structured dtype holding the position(s) ``p`` and
+        log-probability ``ln`` of one sample in the chain.
+        """
+        shape = (self.dim,) if nwalkers is None else (nwalkers, self.dim)
+        return np.dtype([("p", np.float64, shape),
+                         ("ln", np.float64, shape[:-1])])
+
+    def _grow_chain(self, N, nwalkers=None):
+        """
+        Make room for ``N`` more samples in the chain. The storage grows
+        geometrically so that repeated calls to ``sample`` only copy the
+        existing chain a logarithmic number of times. If ``nwalkers`` is
+        given, each sample holds the positions of ``nwalkers`` walkers.
+
+        The positions and log-probabilities are stored together in one
+        structured array, so each sample is written in a single store.
+        """
+        dtype = self._sample_dtype(nwalkers)
+        if self._samples.dtype != dtype:
+            if self._nstored > 0:
+                raise ValueError("Cannot change the number of walkers "
+                                 "without calling reset.")
+            self._samples = np.empty(0, dtype=dtype)
+            self._chain_capacity = 0
+
+        needed = self._nstored + N
+        if needed <= self._chain_capacity:
+            return
+        capacity = max(2 * self._chain_capacity, needed)
+
+        samples = np.empty(capacity, dtype=dtype)
+        samples[:self._nstored] = self._samples[:self._nstored]
+
+        self._samples = samples
+        self._chain_capacity = capacity
+
     @property
     def random_state(self):
         """The state of the internal random number generator."""
-        return self._random.get_state()
+        return self._random.bit_generator.state
 
     @random_state.setter
     def random_state(self, state):
@@ -63,35 +122,105 @@ class Sampler(object):
         silently if it doesn't work.
         """
         try:
-            self._random.set_state(state)
+            self._random.bit_generator.state = state
         except:
             pass
 
     @property
     def acceptance_fraction(self):
         """The fraction of the proposed steps that were accepted."""
+        if self.iterations == 0:
+            return 0.0
         return self.accepted / self.iterations
     
     @property
     def chain(self):
         """Pointer to the Markov chain."""
-        return self._chain
+        return self._samples["p"][:self._nstored]
     
     @property
     def lnprobability(self):
         """
         List of log-probability values associated with each step in the chain.
         """
-        return self._lnprob
+        return self._samples["ln"][:self._nstored]
     
+    @property
+    def lnprobfn(self):
+        """The log-probability function."""
+        return self._lnprobfn
+
+    @lnprobfn.setter
+    def lnprobfn(self, lnprobfn):
+        """Sets ``lnprobfn`` and clears the cache of its evaluations."""
+        self._lnprobfn = lnprobfn
+        self._lnprob_cache = OrderedDict()
+
+    @property
+    def args(self):
+        """Positional arguments for ``lnprobfn``."""
+        return self._args
+
+    @args.setter
+    def args(self, args):
+        """Sets ``args`` and clears the cache of ``lnprobfn`` evaluations."""
+        self._args = args
+        self._lnprob_cache = OrderedDict()
+
+    @property
+    def kwargs(self):
+        """Keyword arguments for ``lnprobfn``."""
+        return self._kwargs
+
+    @kwargs.setter
+    def kwargs(self, kwargs):
+        """Sets ``kwargs`` and clears the cache of ``lnprobfn`` evaluations."""
+        self._kwargs = kwargs
+        self._lnprob_cache = OrderedDict()
+
     def get_lnprob(self, p):
         """The log-probability at the given position."""
-        return self.lnprobfn(p, *self.args, **self.kwargs)
+        if self.lnprob_cache_size <= 0:
+            return self.lnprobfn(p, *self.args, **self.kwargs)
+
+        p = np.asarray(p)
+        key = (p.dtype.char, p.tobytes())
+        cache = self._lnprob_cache
+        try:
+            # Re-insert to mark as the most recently used
+            lnprob = cache.pop(key)
+        except KeyError:
+            lnprob = self.lnprobfn(p, *self.args, **self.kwargs)
+            if len(cache) >= self.lnprob_cache_size:
+                cache.popitem(last=False)
+        cache[key] = lnprob
+        return lnprob
+
+    def _lnprob_function(self):
+        """
+        The function for the sampling loops to call, as
+        ``lnprobfn(p, *args, **kwargs)``, in place of ``get_lnprob``. This
+        is ``lnprobfn`` itself with its arguments, unless the cache is
+        enabled or ``get_lnprob`` is overridden.
+        """
+        if (self.lnprob_cache_size > 0
+                or type(self).get_lnprob is not Sampler.get_lnprob):
+            return self.get_lnprob, (), {}
+        return self._lnprobfn, tuple(self._args), self._kwargs
     
     def sample(self, *args, **kwargs):
         raise NotImplementedError("The sampling routine must be implemented "
                                   "by subclasses")
     
+    def _sample_bulk(self, *args, **kwargs):
+        """
+        Run ``sample`` to the end and return the last result. Subclasses can
+        override this with a loop that doesn't yield every step.
+        """
+        for results in self.sample(*args, **kwargs):
+            pass
+        return results
+    
     def run(self, p0, N, lnprob0=None, rstate0=None, **kwargs):
         """
         Run ``sample`` for ``N`` iterations and return the result.
@@ -105,7 +234,7 @@ class Sampler(object):
             Number of iterations to run ``sample``.        
         lnprob0 : list (optional)
             The log-probability at position ``p0``.
-        rstate0 : list (optional)
+        rstate0 : dict (optional)
             The state of the random number generator.       
         kwargs : dict (optional)
             Other parameters that are provided directly to ``sample``.
@@ -133,11 +262,69 @@ class Sampler(object):
             if rstate0 is None:
                 rstate0 = self._last_run[2]
         
-        for results in self.sample(p0, lnprob0, rstate0, iterations=N, 
-                                   **kwargs):
-            pass
+        results = self._sample_bulk(p0, lnprob0, rstate0, iterations=N,
+                                    **kwargs)
         
         # Store for ``p0=None`` case
         self._last_run = results[:3]
 
         return results
+
+    def run_chains(self, p0s, N, pool=None, seed=None, **kwargs):
+        """
+        Run independent chains from each of the initial positions ``p0s``
+        for ``N`` iterations.
+
+        Parameters
+        ----------
+
+        p0s : list
+            The initial position vector of each chain.
+        N : int
+            Number of iterations to run each chain.
+        pool : object (optional)
+            An object with a ``map`` method, such as
+            ``multiprocessing.Pool`` or
+            ``concurrent.futures.ProcessPoolExecutor``, used to run the
+            chains in parallel. By default the chains are run serially.
+        seed : int (optional)
+            Seed from which the random number generator of each chain is
+            seeded.
+        kwargs : dict (optional)
+            Other parameters that are provided directly to ``run``.
+
+        Returns
+        -------
+
+        samplers : list
+            A copy of this sampler for each chain after it has been run,
+            holding its ``chain``, ``lnprobability`` and book-keeping
+            parameters.
+
+        Notes
+        -----
+
+        Each chain gets its own random number generator spawned from
+        ``np.random.SeedSequence(seed)``, so the results are reproducible
+        for a given ``seed`` regardless of ``pool``. With a process pool,
+        ``lnprobfn`` must be picklable, e.g. defined at the top level of a
+        module.
+        """
+        seeds = np.random.SeedSequence(seed).spawn(len(p0s))
+
+        tasks = []
+        for p0, s in zip(p0s, seeds):
+            sampler = copy.copy(self)
+            sampler.reset()
+            sampler._random = np.random.default_rng(s)
+            tasks.append((sampler, p0, N, kwargs))
+
+        if pool is None:
+            return list(map(_run_chain, tasks))
+        return list(pool.map(_run_chain, tasks))
+
+def _run_chain(task):
+    """Run a single chain for ``Sampler.run_chains``."""
+    sampler, p0, N, kwargs = task
+    sampler.run(p0, N, **kwargs)
+    return sampler
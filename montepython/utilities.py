@@ -21,6 +21,12 @@ def ball(p0, sigma, size=1):
         Standard deviation of Gaussian.
     size : int
         Number of balls to create.
+
+    Returns
+    -------
+
+    ball : ndarray
+        Array of shape ``(size, len(p0))`` with one position vector per row.
     """
-    return [p0 + sigma * np.random.normal(size=len(p0))
-            for i in range(size)]
\ No newline at end of file
+    p0 = np.asarray(p0)
+    return p0 + sigma * np.random.normal(size=(size, p0.size))
\ No newline at end of file
@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from setuptools import setup
+from setuptools import Extension, setup
+
+# The compiled Metropolis loop is optional, the sampler falls back to pure
+# Python if it isn't built
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = cythonize([Extension("montepython._core",
+                                       ["montepython/_core.pyx"])])
 
 setup(
     name="montepython",
@@ -12,4 +22,5 @@ setup(
                  "Python."),
     long_description=open("README.md").read(),
     install_requires=["numpy"],
+    ext_modules=ext_modules,
 )
\ No newline at end of file